@@ -1,46 +1,121 @@
 import os
+import hashlib
+import hmac
+import shutil
 import requests
-import json
+import sqlite3
 import time
-import uuid
+import secrets
+import functools
 import logging
-from flask import Flask, request, jsonify, render_template, send_from_directory
+import threading
+from pathlib import Path
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from flask import Flask, Response, request, jsonify, render_template, send_from_directory
 from flask_cors import CORS
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+from werkzeug.exceptions import RequestEntityTooLarge
+from typing import Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
+from PIL import Image
 import google.generativeai as genai # NEW: Import Gemini library
+import orjson
+from flask.json.provider import DefaultJSONProvider
+from flask.logging import default_handler
 
 # Load environment variables
 load_dotenv()
 
+class ORJSONProvider(DefaultJSONProvider):
+    # orjson encodes/decodes several times faster than the stdlib json module used by jsonify
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__, static_folder="static", template_folder="templates")
+app.json = ORJSONProvider(app)
 CORS(app)
 
 # Define the base directory for saving generated images
 GENERATED_IMAGES_DIR = os.path.join(app.static_folder, 'generated_designs')
 os.makedirs(GENERATED_IMAGES_DIR, exist_ok=True)
 
+# SQLite index of saved designs, kept outside the publicly served static folder
+DESIGNS_DB_PATH = os.getenv("DESIGNS_DB_PATH", os.path.join(app.root_path, 'designs.sqlite'))
+
+# Reuse Flask's default handler rather than adding a second one, which printed every record twice
 app.logger.setLevel(logging.INFO)
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-console_handler.setFormatter(formatter)
-app.logger.addHandler(console_handler)
+default_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 
 # --- Configuration for Leonardo.ai ---
 LEONARDO_API_KEY = os.getenv("LEONARDO_API_KEY")
 LEONARDO_API_BASE_URL = "https://cloud.leonardo.ai/api/rest/v1"
 LEONARDO_DEFAULT_MODEL = "5c232a9e-9061-4777-980a-ddc8e65647c6" # Phoenix Basic Model
+LEONARDO_POLL_INITIAL_DELAY = 0.25 # First wait (seconds) between status checks
+LEONARDO_POLL_MAX_DELAY = 4.0 # Backoff ceiling between status checks
+LEONARDO_POLL_TIMEOUT = 60 # Total seconds to wait for a generation to finish
+# Callback API key configured for the Leonardo webhook; when set, completions are pushed to /leonardo-webhook
+LEONARDO_WEBHOOK_API_KEY = os.getenv("LEONARDO_WEBHOOK_API_KEY")
+
+IMAGE_DOWNLOAD_CHUNK_SIZE = 64 * 1024 # Bytes read from the network per write when saving images
+IMAGE_WRITE_BUFFER_SIZE = 1024 * 1024 # File buffer that batches those chunks into fewer write() syscalls
+IMAGE_DOWNLOAD_TIMEOUT = 30 # Seconds to wait for the CDN to connect or send more data
+DOWNLOAD_WORKERS = 32 # Concurrent image downloads per process, shared by all generations
+SAVED_IMAGE_WEBP_QUALITY = 82 # Generated images are stored as WebP at this quality
+
+# Generations run on background threads; the client polls /status/<folder_id> for the result
+GENERATION_WORKERS = 16 # Concurrent generations per process
+GENERATION_JOB_TIMEOUT = 300 # Seconds after starting that a still-running job is reported as interrupted
+GENERATION_QUEUE_TIMEOUT = 5 * 60 # Seconds a job may wait in the executor queue before it is given up on
+GENERATION_HEARTBEAT_INTERVAL = 10 # Seconds between a worker process's liveness updates
+GENERATION_OWNER_TIMEOUT = 30 # Seconds without a heartbeat after which a process's unfinished jobs are interrupted
+GENERATION_JOB_RETENTION = 24 * 60 * 60 # Seconds a finished job's status stays queryable
+
+# In-memory cache of the /get-saved-designs listing, rebuilt when the designs index changes
+# Holds the already-encoded JSON body and its ETag so unchanged listings skip serialization and hashing
+_saved_designs_cache = {"body": None, "etag": None, "fingerprint": None}
+_saved_designs_lock = threading.Lock()
+IMAGE_EXTENSIONS = frozenset({'.png', '.jpg', '.jpeg', '.gif', '.webp'})
+
+# Files in a design folder never change once written, so browsers may keep them for a year
+GENERATED_IMAGE_MAX_AGE = 31536000 # Seconds
 
 # --- Configuration for Together.ai ---
 TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
 TOGETHER_API_BASE_URL = "https://api.together.ai/v1"
 TOGETHER_FLUX1_MODEL = "black-forest-labs/FLUX.1-dev" # Verify this model string for image generation
+TOGETHER_HEADERS = {
+    "Authorization": f"Bearer {TOGETHER_API_KEY}",
+    "Content-Type": "application/json"
+}
+
+# --- Shared image generation settings ---
+IMAGE_SIZE = 1024 # Width and height of generated images
+MAX_IMAGES_PER_REQUEST = 8
+# Seconds to wait for an image API to connect or send more data; Together.ai answers only once the images exist
+PROVIDER_REQUEST_TIMEOUT = 60
+
+# Request size limits; the body cap also has to fit Leonardo.ai webhook payloads
+app.config['MAX_CONTENT_LENGTH'] = 64 * 1024 # Bytes
+MAX_FIELD_LENGTH = 100 # Characters in a dropdown value, model id or challenge
+MAX_DESCRIPTION_LENGTH = 1000 # Characters in the free-text description
+NEGATIVE_PROMPT = "blurry, low quality, deformed, malformed, text, watermark, ugly, poor lighting"
 
 # --- Configuration for Google Gemini ---
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY") # NEW
+GEMINI_REQUEST_TIMEOUT = 30 # Seconds; a stuck enhancement would otherwise hold a generation thread
+GEMINI_SYSTEM_INSTRUCTION = (
+    "You are an expert jewelry designer and prompt engineer for AI image generation. Take the following user description for a piece of jewelry and expand it into a highly detailed, photorealistic prompt suitable for an what is asked realistic low resolution text-to-image model like Stable Diffusion XL. Focus on adding details about: \n- Material textures (e.g., polished, brushed, matte, sparkling)\n- Lighting (e.g., studio lighting, soft ambient light, dramatic spotlight, reflections)\n- Background (e.g., minimalist white, dark velvet, natural wood, blurred bokeh)\n- Camera angle/shot (e.g., close-up macro, eye-level, slightly elevated)\n- Refinements to the jewelry's design (e.g., intricate filigree, smooth curves, sharp edges, specific stone cuts).\n- Overall mood or aesthetic (e.g., luxurious, modern, vintage, delicate, bold). Make sure user's prompt should give preferance.\n\n"
+    "The original user description is the user's message.\n\n"
+    "Return ONLY the enhanced prompt string, nothing else. Do not include any conversational text, introductions, or conclusions. Just the prompt."
+)
 if GEMINI_API_KEY: # Configure Gemini only if API key is present
     genai.configure(api_key=GEMINI_API_KEY)
-    GEMINI_MODEL = genai.GenerativeModel('gemini-1.5-flash') # Use Gemini 1.5 Flash
+    GEMINI_MODEL = genai.GenerativeModel('gemini-1.5-flash', system_instruction=GEMINI_SYSTEM_INSTRUCTION) # Use Gemini 1.5 Flash
 else:
     app.logger.warning("GEMINI_API_KEY environment variable not set. Prompt enhancement with Gemini will not be available.")
     GEMINI_MODEL = None
@@ -55,61 +130,602 @@ if not TOGETHER_API_KEY:
     app.logger.warning("TOGETHER_API_KEY environment variable not set. Together.ai integration will not work.")
 
 
+# --- Prompt templates ---
+# str.format templates per jewelry type; the text around the placeholders is built once at import
+RING_PROMPT_TEMPLATE = "A high-resolution, ultra-detailed, sharp focus, hyper-realistic jewelry for {gender} rendering of a {jewelry_option} ring, crafted from {metal_type}, featuring a {center_stone_cut} {center_stone_shape} {center_stone_type} center stone, in a {setting_type} setting, with a {side_stone_cut} {side_stone_shape} {side_stone_type} side stones, in a {product_style} style. Photographed in top-down, macro close-up, 3/4 perspective, and side profile displayed on mirrored surface, under softbox studio light, featuring {description} --ar 1:1 --v 6 --style raw."
+MIXED_STONE_PROMPT_TEMPLATE = "A high-resolution, ultra-detailed, sharp focus, hyper-realistic jewelry for {gender} rendering of a {jewelry_option} {piece}, crafted from {metal_type}, featuring a mix of {center_stone_cut} {center_stone_shape} {center_stone_type} and {side_stone_cut} {side_stone_shape} {side_stone_type}, in a {setting_type} setting, in a {product_style} style. Photographed in top-down, macro close-up, 3/4 perspective, and side profile displayed on mirrored surface, under softbox studio light, featuring {description} --ar 1:1 --v 6 --style raw."
+PROMPT_TEMPLATES = {
+    'ring': RING_PROMPT_TEMPLATE,
+    'earring': MIXED_STONE_PROMPT_TEMPLATE.replace('{piece}', 'pair of earrings'),
+    'pendant': MIXED_STONE_PROMPT_TEMPLATE.replace('{piece}', 'pendant'),
+    'necklace': MIXED_STONE_PROMPT_TEMPLATE.replace('{piece}', 'necklace'),
+    'bracelet': MIXED_STONE_PROMPT_TEMPLATE.replace('{piece}', 'bracelet'),
+}
+FALLBACK_PROMPT = "The images should be realistic, detailed, and suitable for a jewelry catalog."
+
+
+# --- Shared HTTP sessions ---
+def create_http_session(retry_reads=True):
+    # Pooled keep-alive connections; idempotent requests are retried on connection errors and gateway errors.
+    # POSTs are never retried, so a generation is not submitted twice.
+    session = requests.Session()
+    retry = Retry(
+        total=3, read=None if retry_reads else 0, backoff_factor=0.3,
+        status_forcelist=(502, 503, 504), raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# Leonardo.ai API calls (generation submit + status polling) share one authenticated session
+# Read timeouts are not retried: the status loop polls again by itself and must stay within its deadline
+LEONARDO_SESSION = create_http_session(retry_reads=False)
+LEONARDO_SESSION.headers.update({"authorization": f"Bearer {LEONARDO_API_KEY}"})
+
+# Together.ai API calls and image downloads from the providers' CDNs; no credentials attached
+HTTP_SESSION = create_http_session()
+
+
+# --- Saved designs index ---
+_db_local = threading.local()
+
+def get_designs_db():
+    # One connection per thread; autocommit with WAL so concurrent workers can read while one writes
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(DESIGNS_DB_PATH, isolation_level=None, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        # Under WAL this only fsyncs at checkpoints; a crash can lose the last commits but never corrupts the index
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _db_local.conn = conn
+    return conn
+
+def scan_design_folders(known_folder_ids=frozenset()):
+    # Returns (folder_id, created_ts, prompt, images_json) rows ready for the designs table
+    app.logger.info("Scanning saved designs on disk.")
+    design_rows = []
+    with os.scandir(GENERATED_IMAGES_DIR) as folders:
+        for folder in folders:
+            # Prompts never change once written, so indexed folders are not read again
+            if folder.name in known_folder_ids or not folder.is_dir(follow_symlinks=False):
+                continue
+            folder_name = folder.name
+            prompt_file = None
+            images_in_folder = []
+            # One directory pass finds both the prompt and the images; is_file() uses the cached d_type
+            with os.scandir(folder.path) as entries:
+                for entry in entries:
+                    if not entry.is_file(follow_symlinks=False):
+                        continue
+                    if entry.name == 'prompt.txt':
+                        prompt_file = entry.path
+                    elif os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                        images_in_folder.append(f"/static/generated_designs/{folder_name}/{entry.name}")
+
+            if not images_in_folder:
+                continue
+
+            prompt_text = "No prompt available."
+            if prompt_file:
+                try:
+                    with open(prompt_file, 'r', encoding='utf-8') as f:
+                        prompt_text = f.read()
+                except Exception as e:
+                    app.logger.error("Error reading prompt.txt in %s: %s", folder_name, e)
+
+            images_in_folder.sort()
+            design_rows.append((folder_name, folder.stat().st_mtime, prompt_text, orjson.dumps(images_in_folder).decode('utf-8')))
+
+    app.logger.info("Found %s unindexed design folders.", len(design_rows))
+    return design_rows
+
+def init_designs_db():
+    conn = get_designs_db()
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS designs ("
+        "folder_id TEXT PRIMARY KEY, created_ts REAL NOT NULL, prompt TEXT NOT NULL, images TEXT NOT NULL)"
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS designs_created_ts ON designs (created_ts DESC)")
+    # Maps a generation request (model, image count, prompt) to the design it produced
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS prompt_cache (cache_key TEXT PRIMARY KEY, folder_id TEXT NOT NULL)"
+    )
+    # Status of background generations, keyed by the design folder they write to
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS generation_jobs ("
+        "folder_id TEXT PRIMARY KEY, status TEXT NOT NULL, images TEXT, error TEXT, updated_ts REAL NOT NULL, "
+        "owner TEXT)"
+    )
+    if 'owner' not in {column[1] for column in conn.execute("PRAGMA table_info(generation_jobs)")}:
+        try:
+            conn.execute("ALTER TABLE generation_jobs ADD COLUMN owner TEXT")
+        except sqlite3.OperationalError:
+            pass # Another worker process added it first
+    # Liveness of the worker processes that own queued and running jobs
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS generation_owners (owner TEXT PRIMARY KEY, heartbeat_ts REAL NOT NULL)"
+    )
+    # Gemini enhancements keyed by a hash of the prompt sent for enhancement
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS gemini_cache (prompt_hash TEXT PRIMARY KEY, enhanced_prompt TEXT NOT NULL)"
+    )
+    # Index folders written before the index existed (or copied in by hand)
+    known_folder_ids = {folder_id for (folder_id,) in conn.execute("SELECT folder_id FROM designs")}
+    rows = scan_design_folders(known_folder_ids)
+    conn.execute("BEGIN")
+    conn.executemany("INSERT OR IGNORE INTO designs VALUES (?, ?, ?, ?)", rows)
+    conn.execute("COMMIT")
+
+def record_design(folder_id, prompt, image_paths, cache_key=None):
+    conn = get_designs_db()
+    conn.execute(
+        "INSERT INTO designs VALUES (?, ?, ?, ?)",
+        (folder_id, time.time(), prompt, orjson.dumps(image_paths).decode('utf-8'))
+    )
+    if cache_key:
+        conn.execute("INSERT OR REPLACE INTO prompt_cache VALUES (?, ?)", (cache_key, folder_id))
+
+def generation_cache_key(model_id, num_images, enhance_prompt, prompt):
+    # Keyed on the prompt before Gemini enhancement so a hit also skips the Gemini call
+    return hashlib.sha256(f"{model_id}|{num_images}|{bool(enhance_prompt)}|{prompt}".encode('utf-8')).hexdigest()
+
+def find_cached_generation(cache_key):
+    row = get_designs_db().execute(
+        "SELECT d.folder_id, d.images FROM prompt_cache p JOIN designs d ON d.folder_id = p.folder_id "
+        "WHERE p.cache_key = ?",
+        (cache_key,)
+    ).fetchone()
+    if row is None:
+        return None
+    folder_id, images = row
+    # The design folder may have been removed by hand since it was cached
+    if not os.path.isdir(os.path.join(GENERATED_IMAGES_DIR, folder_id)):
+        return None
+    return orjson.loads(images)
+
+def load_saved_designs():
+    cursor = get_designs_db().execute("SELECT folder_id, prompt, images FROM designs ORDER BY created_ts DESC")
+    return [
+        {"folder_id": folder_id, "prompt": prompt, "images": orjson.loads(images)}
+        for folder_id, prompt, images in cursor
+    ]
+
+_generation_owner = {"pid": None, "owner_id": None}
+_generation_owner_lock = threading.Lock()
+
+def record_generation_heartbeat(owner_id):
+    get_designs_db().execute("INSERT OR REPLACE INTO generation_owners VALUES (?, ?)", (owner_id, time.time()))
+
+def _generation_heartbeat_loop(owner_id):
+    while True:
+        time.sleep(GENERATION_HEARTBEAT_INTERVAL)
+        try:
+            record_generation_heartbeat(owner_id)
+        except sqlite3.Error as e:
+            app.logger.error("Could not record generation heartbeat: %s", e)
+
+def generation_owner_id():
+    # One id per worker process, checked by pid so forked workers never share one; a heartbeat thread keeps it
+    # fresh in generation_owners and jobs whose owner stops beating are reported as interrupted right away
+    with _generation_owner_lock:
+        if _generation_owner["pid"] != os.getpid():
+            owner_id = f"{os.getpid()}-{secrets.token_hex(4)}"
+            record_generation_heartbeat(owner_id)
+            threading.Thread(target=_generation_heartbeat_loop, args=(owner_id,), name="generation-heartbeat", daemon=True).start()
+            _generation_owner.update(pid=os.getpid(), owner_id=owner_id)
+        return _generation_owner["owner_id"]
+
+def create_generation_job(folder_id):
+    conn = get_designs_db()
+    now = time.time()
+    conn.execute("DELETE FROM generation_jobs WHERE updated_ts < ?", (now - GENERATION_JOB_RETENTION,))
+    conn.execute("DELETE FROM generation_owners WHERE heartbeat_ts < ?", (now - GENERATION_JOB_RETENTION,))
+    conn.execute(
+        "INSERT INTO generation_jobs (folder_id, status, updated_ts, owner) VALUES (?, 'pending', ?, ?)",
+        (folder_id, now, generation_owner_id())
+    )
+
+def start_generation_job(folder_id):
+    # False when the job waited in the queue so long that /status already reports it as interrupted
+    now = time.time()
+    cursor = get_designs_db().execute(
+        "UPDATE generation_jobs SET status = 'running', updated_ts = ? "
+        "WHERE folder_id = ? AND status = 'pending' AND updated_ts >= ?",
+        (now, folder_id, now - GENERATION_QUEUE_TIMEOUT)
+    )
+    return cursor.rowcount == 1
+
+def finish_generation_job(folder_id, images=None, error=None):
+    get_designs_db().execute(
+        "UPDATE generation_jobs SET status = ?, images = ?, error = ?, updated_ts = ? WHERE folder_id = ?",
+        (
+            'failed' if error else 'complete',
+            orjson.dumps(images).decode('utf-8') if images else None,
+            error,
+            time.time(),
+            folder_id
+        )
+    )
+
+def get_generation_job(folder_id):
+    row = get_designs_db().execute(
+        "SELECT j.status, j.images, j.error, j.updated_ts, o.heartbeat_ts FROM generation_jobs j "
+        "LEFT JOIN generation_owners o ON o.owner = j.owner WHERE j.folder_id = ?",
+        (folder_id,)
+    ).fetchone()
+    if row is None:
+        return None
+    status, images, error, updated_ts, heartbeat_ts = row
+    job = {"folder_id": folder_id, "status": status}
+    now = time.time()
+    # updated_ts is the enqueue time while pending and the start time while running
+    age = now - updated_ts
+    owner_gone = heartbeat_ts is None or now - heartbeat_ts > GENERATION_OWNER_TIMEOUT
+    if status in ('pending', 'running') and (
+        owner_gone
+        or (status == 'pending' and age > GENERATION_QUEUE_TIMEOUT)
+        or (status == 'running' and age > GENERATION_JOB_TIMEOUT)
+    ):
+        # The worker holding it was restarted, died or is stuck; it will never finish
+        job.update(status='failed', error="Image generation was interrupted. Please try again.")
+    elif status == 'complete':
+        job["images"] = orjson.loads(images)
+    elif status == 'failed':
+        job["error"] = error
+    return job
+
+def saved_designs_fingerprint():
+    # Designs are only ever added, so the row count and newest timestamp change whenever any worker saves one
+    return get_designs_db().execute("SELECT COUNT(*), MAX(created_ts) FROM designs").fetchone()
+
+init_designs_db()
+
+
+# --- Leonardo.ai webhook callbacks ---
+# generation_id -> (created, Future); the webhook resolves the future with the generation's status and images,
+# in the same shape as the polled generations_by_pk, which wakes the waiting job
+_leonardo_callbacks = {}
+_leonardo_callbacks_lock = threading.Lock()
+
+def leonardo_callback_future(generation_id):
+    # Created by whichever side arrives first: the waiting job or the webhook
+    with _leonardo_callbacks_lock:
+        now = time.monotonic()
+        # Drop callbacks nobody waited for, e.g. ones delivered to a different worker process
+        stale_ids = [gid for gid, (created, _) in _leonardo_callbacks.items() if now - created > LEONARDO_POLL_TIMEOUT]
+        for stale_id in stale_ids:
+            del _leonardo_callbacks[stale_id]
+        if generation_id not in _leonardo_callbacks:
+            _leonardo_callbacks[generation_id] = (now, Future())
+        return _leonardo_callbacks[generation_id][1]
+
+def release_leonardo_callback(generation_id):
+    with _leonardo_callbacks_lock:
+        _leonardo_callbacks.pop(generation_id, None)
+
+
 # --- Helper Function to Save Images ---
-def save_images_locally(image_urls, full_prompt):
-    local_image_paths = []
-    folder_uuid = str(uuid.uuid4())
-    save_dir = os.path.join(GENERATED_IMAGES_DIR, folder_uuid)
-    os.makedirs(save_dir, exist_ok=True)
-    app.logger.info(f"Created local folder: {save_dir}")
-
-    prompt_file_path = os.path.join(save_dir, 'prompt.txt')
-    with open(prompt_file_path, 'w', encoding='utf-8') as f:
-        f.write(full_prompt)
-    app.logger.info(f"Saved prompt to {prompt_file_path}")
-
-    for i, img_url in enumerate(image_urls):
+def store_image_as_webp(download_path, save_dir, base_name):
+    # Provider images are large PNG/JPEG files; WebP is several times smaller at the same visual quality
+    img_filename = f"{base_name}.webp"
+    try:
+        with Image.open(download_path) as img:
+            img.convert('RGB').save(os.path.join(save_dir, img_filename), 'WEBP', quality=SAVED_IMAGE_WEBP_QUALITY, method=6)
+        os.remove(download_path)
+    except Exception as convert_err:
+        # Keep the original bytes if Pillow can't read them
+        app.logger.warning("Could not convert %s to WebP, keeping original: %s", download_path, convert_err)
+        img_filename = f"{base_name}.png"
+        os.replace(download_path, os.path.join(save_dir, img_filename))
+    return img_filename
+
+# Long-lived so generations don't spawn and tear down download threads on every call
+DOWNLOAD_POOL = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix="img-dl")
+
+def save_images_locally(folder_id, image_urls, full_prompt, cache_key=None):
+    save_dir = os.path.join(GENERATED_IMAGES_DIR, folder_id)
+    # Built once here rather than per image inside the download workers
+    path_prefix = save_dir + os.sep
+    url_prefix = f"/static/generated_designs/{folder_id}/"
+    # Folder ids are freshly generated per job, so the directory cannot already exist
+    os.mkdir(save_dir)
+
+    def download_image(i, img_url):
+        base_name = f"image_{i+1}"
+        download_path = f"{path_prefix}{base_name}.download"
         try:
-            img_data = requests.get(img_url).content
-            img_filename = f"image_{i+1}.png"
-            img_path = os.path.join(save_dir, img_filename)
-            with open(img_path, 'wb') as handler:
-                handler.write(img_data)
-            local_image_paths.append(f"/static/generated_designs/{folder_uuid}/{img_filename}")
-            app.logger.info(f"Saved image {img_filename} to {save_dir}")
+            # Stream the body to disk in chunks instead of holding the whole image in memory
+            with HTTP_SESSION.get(img_url, stream=True, timeout=IMAGE_DOWNLOAD_TIMEOUT) as img_response:
+                img_response.raise_for_status()
+                img_response.raw.decode_content = True # Undo any gzip/deflate transfer encoding
+                with open(download_path, 'wb', buffering=IMAGE_WRITE_BUFFER_SIZE) as handler:
+                    shutil.copyfileobj(img_response.raw, handler, IMAGE_DOWNLOAD_CHUNK_SIZE)
+            return url_prefix + store_image_as_webp(download_path, save_dir, base_name)
         except Exception as img_save_err:
-            app.logger.error(f"Failed to save image from {img_url}: {img_save_err}")
+            app.logger.error("Failed to save image from %s: %s", img_url, img_save_err)
+            # Don't leave a truncated download behind if the transfer broke off part way
+            if os.path.exists(download_path):
+                os.remove(download_path)
+            return None
+
+    # Downloads are network-bound, so fetch them concurrently; map() keeps the original order
+    results = DOWNLOAD_POOL.map(download_image, range(len(image_urls)), image_urls)
+    # Written while the downloads are in flight
+    Path(save_dir, 'prompt.txt').write_text(full_prompt, encoding='utf-8')
+    local_image_paths = [path for path in results if path]
+    # One summary line per design instead of one per file; failures are still logged individually above
+    app.logger.info("Saved prompt and %d of %d images to %s", len(local_image_paths), len(image_urls), save_dir)
+    if local_image_paths:
+        # Only a complete result may answer later identical requests; a partial one is kept but not reused
+        complete = len(local_image_paths) == len(image_urls)
+        record_design(folder_id, full_prompt, local_image_paths, cache_key if complete else None)
     return local_image_paths
 
 # --- NEW: Function to enhance prompt using Gemini ---
+def gemini_prompt_hash(user_prompt):
+    return hashlib.blake2b(user_prompt.encode('utf-8'), digest_size=16).hexdigest()
+
+def find_cached_gemini_enhancement(user_prompt):
+    # Every enhancement held in memory was also stored here, so a miss means a real Gemini call is coming
+    row = get_designs_db().execute(
+        "SELECT enhanced_prompt FROM gemini_cache WHERE prompt_hash = ?", (gemini_prompt_hash(user_prompt),)
+    ).fetchone()
+    return row[0] if row else None
+
+@functools.lru_cache(maxsize=1024)
+def _enhance_prompt_cached(user_prompt):
+    # Raises on failure so that only successful enhancements are memoized
+    cached_text = find_cached_gemini_enhancement(user_prompt)
+    if cached_text is not None:
+        app.logger.info("Using cached Gemini enhancement for prompt hash %s", gemini_prompt_hash(user_prompt))
+        return cached_text
+
+    # The instructions are attached to the model, so only the description itself is sent
+    response = GEMINI_MODEL.generate_content(user_prompt, request_options={"timeout": GEMINI_REQUEST_TIMEOUT})
+    enhanced_text = response.candidates[0].content.parts[0].text.strip()
+    get_designs_db().execute(
+        "INSERT OR REPLACE INTO gemini_cache VALUES (?, ?)", (gemini_prompt_hash(user_prompt), enhanced_text)
+    )
+    return enhanced_text
+
 def enhance_prompt_with_gemini(user_prompt):
-    app.logger.info(f"Enhancing prompt with Gemini Input Prompt: '{user_prompt}'")
+    app.logger.info("Enhancing prompt with Gemini Input Prompt: '%s'", user_prompt)
     if not GEMINI_MODEL:
         app.logger.warning("Gemini API not configured. Skipping prompt enhancement.")
         return user_prompt # Return original prompt if Gemini is not available
 
     try:
-        app.logger.info(f"Attempting to enhance prompt with Gemini: '{user_prompt}'")
-        # Construct the message for Gemini
-        chat_history = [
-            {
-                "role": "user",
-                "parts": [
-                    {
-                        "text": f"You are an expert jewelry designer and prompt engineer for AI image generation. Take the following user description for a piece of jewelry and expand it into a highly detailed, photorealistic prompt suitable for an what is asked realistic low resolution text-to-image model like Stable Diffusion XL. Focus on adding details about: \n- Material textures (e.g., polished, brushed, matte, sparkling)\n- Lighting (e.g., studio lighting, soft ambient light, dramatic spotlight, reflections)\n- Background (e.g., minimalist white, dark velvet, natural wood, blurred bokeh)\n- Camera angle/shot (e.g., close-up macro, eye-level, slightly elevated)\n- Refinements to the jewelry's design (e.g., intricate filigree, smooth curves, sharp edges, specific stone cuts).\n- Overall mood or aesthetic (e.g., luxurious, modern, vintage, delicate, bold). Make sure user's prompt should give preferance.\n\nOriginal user description: '{user_prompt}'\n\nReturn ONLY the enhanced prompt string, nothing else. Do not include any conversational text, introductions, or conclusions. Just the prompt."
-                    }
-                ]
-            }
-        ]
-
-        response = GEMINI_MODEL.generate_content(chat_history)
-        enhanced_text = response.candidates[0].content.parts[0].text.strip()
-        app.logger.info(f"Gemini enhanced prompt: '{enhanced_text}'")
+        # Identical selections produce identical prompts, so repeats are served from memory or the index
+        enhanced_text = _enhance_prompt_cached(user_prompt)
+        app.logger.info("Gemini enhanced prompt: '%s'", enhanced_text)
         return enhanced_text
     except Exception as e:
-        app.logger.error(f"Error enhancing prompt with Gemini: {e}", exc_info=True)
+        app.logger.error("Error enhancing prompt with Gemini: %s", e, exc_info=True)
         return user_prompt # Fallback to original prompt on error
 
+# --- Background image generation ---
+class GenerationError(Exception):
+    # A provider failure whose message is shown to the user as the job's error
+    pass
+
+GENERATION_EXECUTOR = ThreadPoolExecutor(max_workers=GENERATION_WORKERS, thread_name_prefix="generation")
+
+def warm_provider_connection(model_id):
+    # Any response will do; this only leaves an open keep-alive connection in the session's pool
+    if model_id == "together-flux1.dev":
+        session, url = HTTP_SESSION, TOGETHER_API_BASE_URL
+    else:
+        session, url = LEONARDO_SESSION, LEONARDO_API_BASE_URL
+    try:
+        session.head(url, timeout=5)
+    except requests.exceptions.RequestException as e:
+        app.logger.debug("Could not pre-connect to %s: %s", url, e)
+
+def generate_with_together(prompt, num_images):
+    if num_images > 4:
+        app.logger.warning("Together.ai only supports up to 4 images per request. Reducing num_images from %s to 4.", num_images)
+        num_images = 4
+
+    payload = {
+        "prompt": prompt,
+        "model": TOGETHER_FLUX1_MODEL,
+        "n": num_images,
+        "width": IMAGE_SIZE,
+        "height": IMAGE_SIZE,
+        "negative_prompt": NEGATIVE_PROMPT,
+        "output_format": "jpeg" # Request URLs directly
+    }
+
+    try:
+        app.logger.info("Calling Together.ai API with model: %s", TOGETHER_FLUX1_MODEL)
+        together_response = HTTP_SESSION.post(
+            f"{TOGETHER_API_BASE_URL}/images/generations",
+            headers=TOGETHER_HEADERS,
+            json=payload,
+            timeout=PROVIDER_REQUEST_TIMEOUT
+        )
+        together_response.raise_for_status()
+        together_data = together_response.json()
+    except requests.exceptions.HTTPError as http_err:
+        app.logger.error("Together.ai HTTP error occurred: %s", http_err)
+        app.logger.error("Together.ai Response content: %s", http_err.response.text)
+        raise GenerationError(f"Together.ai API error: {http_err.response.text}") from http_err
+    except requests.exceptions.RequestException as req_err:
+        app.logger.error("Together.ai Request error occurred: %s", req_err)
+        raise GenerationError("Together.ai network or API connection error.") from req_err
+
+    if not together_data.get('data'): # Together.ai API returns 'data' key for image URLs
+        app.logger.error("Together.ai response missing 'data' or 'url': %s", together_data)
+        raise GenerationError("Together.ai did not return expected image data.")
+
+    image_urls = [item['url'] for item in together_data['data'] if item.get('url')]
+    app.logger.info("Received %s images from Together.ai.", len(image_urls))
+    return image_urls
+
+def generate_with_leonardo(model_id, prompt, num_images):
+    payload = {
+        "prompt": prompt,
+        "modelId": model_id if model_id else LEONARDO_DEFAULT_MODEL,
+        "num_images": num_images,
+        "width": IMAGE_SIZE,
+        "height": IMAGE_SIZE,
+        "guidance_scale": 7,
+        "negative_prompt": NEGATIVE_PROMPT,
+        "public": False
+    }
+
+    image_urls = []
+    generation_id = None
+    try:
+        app.logger.info("Calling Leonardo.ai API with model: %s", payload['modelId'])
+        generate_response = LEONARDO_SESSION.post(
+            f"{LEONARDO_API_BASE_URL}/generations",
+            json=payload,
+            timeout=PROVIDER_REQUEST_TIMEOUT
+        )
+        generate_response.raise_for_status()
+        generation_data = generate_response.json()
+
+        generation_id = generation_data['sdGenerationJob']['generationId']
+        app.logger.info("Generation job started with ID: %s", generation_id)
+
+        # Wait on the webhook future between polls; polling uses a capped exponential backoff so fast jobs are
+        # picked up quickly. With a webhook configured the wait ends as soon as the callback arrives and polling
+        # is only a fallback, e.g. for callbacks delivered to another worker process.
+        callback = leonardo_callback_future(generation_id)
+        delay = LEONARDO_POLL_MAX_DELAY if LEONARDO_WEBHOOK_API_KEY else LEONARDO_POLL_INITIAL_DELAY
+        deadline = time.monotonic() + LEONARDO_POLL_TIMEOUT
+        while time.monotonic() < deadline:
+            # Generations never finish instantly, so the first wait comes before the first status request
+            try:
+                gen_info = callback.result(timeout=delay)
+            except FutureTimeoutError:
+                # A stalled status request may not run past the overall polling deadline
+                status_response = LEONARDO_SESSION.get(
+                    f"{LEONARDO_API_BASE_URL}/generations/{generation_id}",
+                    timeout=max(1.0, min(PROVIDER_REQUEST_TIMEOUT, deadline - time.monotonic()))
+                )
+                status_response.raise_for_status()
+                status_data = status_response.json()
+                gen_info = status_data.get('generations_by_pk')
+
+            if gen_info and gen_info.get('status') == 'COMPLETE':
+                app.logger.info("Leonardo.ai Generation complete!")
+                for image in gen_info.get('generated_images', []):
+                    image_urls.append(image['url'])
+                break
+            elif gen_info and gen_info.get('status') == 'FAILED':
+                app.logger.error("Leonardo.ai Generation failed!")
+                raise GenerationError("Leonardo.ai image generation failed.")
+
+            delay = min(delay * 1.5, LEONARDO_POLL_MAX_DELAY)
+    except requests.exceptions.HTTPError as http_err:
+        app.logger.error("Leonardo.ai HTTP error occurred: %s", http_err)
+        app.logger.error("Leonardo.ai Response content: %s", http_err.response.text)
+        raise GenerationError(f"Leonardo.ai API error: {http_err.response.text}") from http_err
+    except requests.exceptions.RequestException as req_err:
+        app.logger.error("Leonardo.ai Request error occurred: %s", req_err)
+        raise GenerationError("Leonardo.ai network or API connection error.") from req_err
+    finally:
+        if generation_id:
+            release_leonardo_callback(generation_id)
+
+    if not image_urls:
+        app.logger.error("Leonardo.ai image generation timed out or no images returned.")
+        raise GenerationError("Leonardo.ai image generation timed out or no images returned.")
+
+    app.logger.info("Received %s images from Leonardo.ai.", len(image_urls))
+    return image_urls
+
+def run_generation_job(folder_id, model_id, initial_prompt, enhance_prompt, num_images, cache_key):
+    # Runs on GENERATION_EXECUTOR; every outcome is written to the job row that /status reads
+    provider = "Together.ai" if model_id == "together-flux1.dev" else "Leonardo.ai"
+    if not start_generation_job(folder_id):
+        app.logger.warning("Skipping generation %s; it waited too long in the queue.", folder_id)
+        return
+    try:
+        # Enhance prompt with Gemini if enabled
+        if enhance_prompt:  # Only enhance if checkbox is checked
+            # Set up the provider connection while Gemini works so the generation request skips the TLS handshake;
+            # only worth it when a real Gemini round trip is coming, otherwise the warm-up races the generation request
+            if GEMINI_MODEL and find_cached_gemini_enhancement(initial_prompt) is None:
+                DOWNLOAD_POOL.submit(warm_provider_connection, model_id)
+            prompt = enhance_prompt_with_gemini(initial_prompt)
+        else:
+            prompt = initial_prompt  # Use original prompt
+        app.logger.info("Final prompt for image generation (enhanced: %s): %s", enhance_prompt, prompt)
+
+        if model_id == "together-flux1.dev":
+            image_urls = generate_with_together(prompt, num_images)
+            saved_prompt = prompt
+        else:
+            image_urls = generate_with_leonardo(model_id, prompt, num_images)
+            saved_prompt = prompt + f"(Model: {model_id})"
+
+        local_image_paths = save_images_locally(folder_id, image_urls, saved_prompt, cache_key) # Save enhanced prompt
+        if not local_image_paths:
+            raise GenerationError(f"No images were successfully saved locally from {provider}.")
+        finish_generation_job(folder_id, images=local_image_paths)
+    except GenerationError as gen_err:
+        finish_generation_job(folder_id, error=str(gen_err))
+    except Exception as e:
+        app.logger.critical("An unexpected error occurred during %s call: %s", provider, e, exc_info=True)
+        finish_generation_job(folder_id, error=f"An internal server error occurred during {provider} call.")
+
+
+# --- Request validation ---
+class JewelryRequest(BaseModel):
+    # Every value ends up in the prompt sent to Gemini and the image API, so oversized input is rejected up front
+    model_config = ConfigDict(str_max_length=MAX_FIELD_LENGTH)
+
+    jewelry_type: Optional[str] = None
+    jewelry_option: Optional[str] = None
+    metal_type: Optional[str] = None
+    center_stone_type: Optional[str] = None
+    side_stone_type: Optional[str] = None
+    center_stone_shape: Optional[str] = None
+    side_stone_shape: Optional[str] = None
+    center_stone_cut: Optional[str] = None
+    side_stone_cut: Optional[str] = None
+    gender: Optional[str] = None
+    description: Optional[str] = Field('', max_length=MAX_DESCRIPTION_LENGTH)
+    product_style: Optional[str] = ''
+    setting_type: Optional[str] = ''
+    model: str = 'together-flux1.dev' # Default model is Together-black-forest-labs/FLUX.1-dev
+    numImages: int = Field(1, ge=1, le=MAX_IMAGES_PER_REQUEST)
+    enhancePrompt: bool = False
+    newVariations: bool = False # Skip the cached images of an identical earlier request
+    challenge: Optional[str] = '' # Checked before validation, see check_generation_challenge
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_request_too_large(err):
+    app.logger.warning("Rejected request body larger than %s bytes.", app.config['MAX_CONTENT_LENGTH'])
+    return jsonify({"error": "Request is too large."}), 413
+
+@app.errorhandler(ValidationError)
+def handle_validation_error(err):
+    details = "; ".join(f"{'.'.join(str(part) for part in e['loc']) or 'body'}: {e['msg']}" for e in err.errors())
+    app.logger.warning("Rejected invalid request: %s", details)
+    return jsonify({"error": f"Invalid request: {details}"}), 400
+
+@app.before_request
+def check_generation_challenge():
+    # CORS preflights carry no body or passphrase and must succeed for the browser to send the real POST
+    if request.endpoint != 'generate_jewelry' or request.method != 'POST':
+        return None
+    # The frontend sends the passphrase as a header so unauthorized requests are rejected before the body is parsed;
+    # older clients that only put it in the JSON body are still accepted
+    challenge_input = request.headers.get('X-Challenge')
+    if challenge_input is None:
+        body = request.get_json(silent=True)
+        challenge_input = body.get('challenge') if isinstance(body, dict) else None
+    # Block if challenge_input is NOT provided OR it's NOT "i love lp" (case-insensitive)
+    if not isinstance(challenge_input, str) or challenge_input.lower() != "i love lp":
+        app.logger.warning("Unauthorized access attempt detected with challenge: '%s'", challenge_input)
+        return jsonify({"error": "You are not authorized to use this, please contact info@livepointsolutions.com."}), 403 # 403 Forbidden
+    return None
+
 # --- Routes ---
 
 @app.route('/')
@@ -123,240 +739,146 @@ def design():
     return render_template('design.html')
 
 
-@app.route('/generate-jewelry', methods=['POST'])
-def generate_jewelry():
-    data = request.json
-    app.logger.info(f"Received data from frontend: {data}")
-
-    jewelry_type = data.get('jewelry_type')
-    jewelry_option = data.get('jewelry_option')
-    metal_type = data.get('metal_type')
-    center_stone_type = data.get('center_stone_type')
-    side_stone_type = data.get('side_stone_type')
-    center_stone_shape = data.get('center_stone_shape')
-    side_stone_shape = data.get('side_stone_shape')
-    center_stone_cut = data.get('center_stone_cut')
-    side_stone_cut = data.get('side_stone_cut')
-    gender = data.get('gender')
-    description = data.get('description', '')
-    product_style = data.get('product_style', '')  # NEW: Get product style
-    setting_type = data.get('setting_type', '')  # NEW: Get setting type
-    selected_model_id = data.get('model', 'together-flux1.dev') # Default model is Together-black-forest-labs/FLUX.1-dev
-    num_images = data.get('numImages', 1)
-    enhance_prompt = data.get('enhancePrompt', False) # NEW: Get checkbox state
-    challenge_input = data.get('challenge', '') # NEW: Get challenge passphrase
-
-    # Block if challenge_input is NOT provided OR it's NOT "i love lp" (case-insensitive)
-    if not challenge_input or challenge_input.lower() != "i love lp":
-        app.logger.warning(f"Unauthorized access attempt detected with challenge: '{challenge_input}'")
-        return jsonify({"error": "You are not authorized to use this, please contact info@livepointsolutions.com."}), 403 # 403 Forbidden
-    # --- END CORRECTED ---
-    # Construct initial prompt
-    if jewelry_type == 'ring':
-        initial_prompt_for_gemini = f"A high-resolution, ultra-detailed, sharp focus, hyper-realistic jewelry for {gender} rendering of a {jewelry_option} ring, crafted from {metal_type}, featuring a {center_stone_cut} {center_stone_shape} {center_stone_type} center stone, in a {setting_type} setting, with a {side_stone_cut} {side_stone_shape} {side_stone_type} side stones, in a {product_style or '[Product Style]'} style. Photographed in top-down, macro close-up, 3/4 perspective, and side profile displayed on mirrored surface, under softbox studio light, featuring {description or '[Comments]'} --ar 1:1 --v 6 --style raw."
-
-    elif jewelry_type == 'earring':
-        initial_prompt_for_gemini = f"A high-resolution, ultra-detailed, sharp focus, hyper-realistic jewelry for {gender} rendering of a {jewelry_option} pair of earrings, crafted from {metal_type}, featuring a mix of {center_stone_cut} {center_stone_shape} {center_stone_type} and {side_stone_cut} {side_stone_shape} {side_stone_type}, in a {setting_type} setting, in a {product_style or '[Product Style]'} style. Photographed in top-down, macro close-up, 3/4 perspective, and side profile displayed on mirrored surface, under softbox studio light, featuring {description or '[Comments]'} --ar 1:1 --v 6 --style raw."
-
-    elif jewelry_type == 'pendant':
-        initial_prompt_for_gemini = f"A high-resolution, ultra-detailed, sharp focus, hyper-realistic jewelry for {gender} rendering of a {jewelry_option} pendant, crafted from {metal_type}, featuring a mix of {center_stone_cut} {center_stone_shape} {center_stone_type} and {side_stone_cut} {side_stone_shape} {side_stone_type}, in a {setting_type} setting, in a {product_style or '[Product Style]'} style. Photographed in top-down, macro close-up, 3/4 perspective, and side profile displayed on mirrored surface, under softbox studio light, featuring {description or '[Comments]'} --ar 1:1 --v 6 --style raw."
-
-    elif jewelry_type == 'necklace':
-        initial_prompt_for_gemini = f"A high-resolution, ultra-detailed, sharp focus, hyper-realistic jewelry for {gender} rendering of a {jewelry_option} necklace, crafted from {metal_type}, featuring a mix of {center_stone_cut} {center_stone_shape} {center_stone_type} and {side_stone_cut} {side_stone_shape} {side_stone_type}, in a {setting_type} setting, in a {product_style or '[Product Style]'} style. Photographed in top-down, macro close-up, 3/4 perspective, and side profile displayed on mirrored surface, under softbox studio light, featuring {description or '[Comments]'} --ar 1:1 --v 6 --style raw."
-
-    elif jewelry_type == 'bracelet':
-        initial_prompt_for_gemini = f"A high-resolution, ultra-detailed, sharp focus, hyper-realistic jewelry for {gender} rendering of a {jewelry_option} bracelet, crafted from {metal_type}, featuring a mix of {center_stone_cut} {center_stone_shape} {center_stone_type} and {side_stone_cut} {side_stone_shape} {side_stone_type}, in a {setting_type} setting, in a {product_style or '[Product Style]'} style. Photographed in top-down, macro close-up, 3/4 perspective, and side profile displayed on mirrored surface, under softbox studio light, featuring {description or '[Comments]'} --ar 1:1 --v 6 --style raw."
+@app.route('/static/generated_designs/<folder_id>/<filename>')
+def generated_design_file(folder_id, filename):
+    # Takes precedence over the generic static route for this subtree; designs are exactly one folder deep
+    response = send_from_directory(GENERATED_IMAGES_DIR, f"{folder_id}/{filename}", max_age=GENERATED_IMAGE_MAX_AGE)
+    response.headers['Cache-Control'] = f"public, max-age={GENERATED_IMAGE_MAX_AGE}, immutable"
+    return response
 
-    else:
-        initial_prompt_for_gemini = "The images should be realistic, detailed, and suitable for a jewelry catalog."
-
-    # Enhance prompt with Gemini if enabled
-    if enhance_prompt:  # Only enhance if checkbox is checked
-        final_prompt_for_image_gen = enhance_prompt_with_gemini(initial_prompt_for_gemini)
-    else:
-        final_prompt_for_image_gen = initial_prompt_for_gemini  # Use original prompt
-
-    app.logger.info(f"Final prompt for image generation (enhanced: {enhance_prompt}): {final_prompt_for_image_gen}")
-    # --- END Conditional Prompt Enhancement ---
-
-    leonardo_image_urls = []
-    together_image_urls = []
 
-    # --- Conditional API Call Logic ---
+@app.route('/generate-jewelry', methods=['POST'])
+def generate_jewelry():
+    # Parses and validates the JSON body in one pass; errors become a 400 via handle_validation_error
+    design_request = JewelryRequest.model_validate_json(request.get_data())
+    app.logger.info("Received data from frontend: %s", design_request)
+
+    jewelry_type = design_request.jewelry_type
+    jewelry_option = design_request.jewelry_option
+    metal_type = design_request.metal_type
+    center_stone_type = design_request.center_stone_type
+    side_stone_type = design_request.side_stone_type
+    center_stone_shape = design_request.center_stone_shape
+    side_stone_shape = design_request.side_stone_shape
+    center_stone_cut = design_request.center_stone_cut
+    side_stone_cut = design_request.side_stone_cut
+    gender = design_request.gender
+    description = design_request.description
+    product_style = design_request.product_style
+    setting_type = design_request.setting_type
+    selected_model_id = design_request.model
+    num_images = design_request.numImages
+    enhance_prompt = design_request.enhancePrompt
+
+    # The challenge passphrase was already checked in check_generation_challenge
+    # Reject requests the selected provider can't serve before spending any API calls
     if selected_model_id == "together-flux1.dev":
         if not TOGETHER_API_KEY:
             app.logger.error("Together.ai API key is not set. Cannot use Together.ai model.")
             return jsonify({"error": "Together.ai API key not configured."}), 500
+    elif selected_model_id == '5c232a9e-9061-4777-980a-ddc8e65647c6':
+        return jsonify({"error": "The Leonardo base model is no longer available. Please select another model."}), 400
 
-        if num_images > 4:
-            app.logger.warning(f"Together.ai only supports up to 4 images per request. Reducing num_images from {num_images} to 4.")
-            num_images = 4
-
-        model_name_for_together = TOGETHER_FLUX1_MODEL
-
-        headers = {
-            "Authorization": f"Bearer {TOGETHER_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        payload = {
-            "prompt": final_prompt_for_image_gen, # Use enhanced prompt
-            "model": model_name_for_together,
-            "n": num_images,
-            "width": 1024, # Set to 1024x1024 as per earlier requirement
-            "height": 1024,
-            "negative_prompt": "blurry, low quality, deformed, malformed, text, watermark, ugly, poor lighting",
-            "output_format": "jpeg" # Request URLs directly
-        }
-
-        try:
-            app.logger.info(f"Calling Together.ai API with model: {model_name_for_together}")
-            together_response = requests.post(
-                f"{TOGETHER_API_BASE_URL}/images/generations",
-                headers=headers,
-                json=payload
-            )
-            together_response.raise_for_status()
-            together_data = together_response.json()
-
-            if together_data.get('data'): # Together.ai API returns 'data' key for image URLs
-                for item in together_data['data']:
-                    if item.get('url'):
-                        together_image_urls.append(item['url'])
-            else:
-                app.logger.error(f"Together.ai response missing 'data' or 'url': {together_data}")
-                return jsonify({"error": "Together.ai did not return expected image data."}), 500
-
-
-            app.logger.info(f"Received {len(together_image_urls)} images from Together.ai.")
-            local_image_paths = save_images_locally(together_image_urls, final_prompt_for_image_gen) # Save enhanced prompt
-            if not local_image_paths:
-                return jsonify({"error": "No images were successfully saved locally from Together.ai."}), 500
-            return jsonify({"images": local_image_paths})
-
-        except requests.exceptions.HTTPError as http_err:
-            app.logger.error(f"Together.ai HTTP error occurred: {http_err}")
-            app.logger.error(f"Together.ai Response content: {http_err.response.text}")
-            return jsonify({"error": f"Together.ai API error: {http_err.response.text}"}), http_err.response.status_code
-        except requests.exceptions.RequestException as req_err:
-            app.logger.error(f"Together.ai Request error occurred: {req_err}")
-            return jsonify({"error": "Together.ai network or API connection error."}), 500
-        except Exception as e:
-            app.logger.critical(f"An unexpected error occurred during Together.ai call: {e}", exc_info=True)
-            return jsonify({"error": "An internal server error occurred during Together.ai call."}), 500
-
-    else: # Leonardo.ai
-        if selected_model_id == '5c232a9e-9061-4777-980a-ddc8e65647c6':
-            return jsonify({"error": "The Leonardo base model is no longer available. Please select another model."}), 400
-
-        if not (1 <= num_images <= 8):
-            app.logger.warning(f"Invalid num_images received for Leonardo.ai: {num_images}. Defaulting to 4.")
-            num_images = 4
-
-        headers = {
-            "authorization": f"Bearer {LEONARDO_API_KEY}",
-            "Content-Type": "application/json"
-        }
-
-        payload = {
-            "prompt": final_prompt_for_image_gen, # Use enhanced prompt
-            "modelId": selected_model_id if selected_model_id else LEONARDO_DEFAULT_MODEL,
-            "num_images": num_images,
-            "width": 1024, # Ensure width and height are 1024
-            "height": 1024,
-            "guidance_scale": 7,
-            "negative_prompt": "blurry, low quality, deformed, malformed, text, watermark, ugly, poor lighting",
-            "public": False
-        }
-
-        try:
-            app.logger.info(f"Calling Leonardo.ai API with model: {payload['modelId']}")
-            generate_response = requests.post(
-                f"{LEONARDO_API_BASE_URL}/generations",
-                headers=headers,
-                json=payload
-            )
-            generate_response.raise_for_status()
-            generation_data = generate_response.json()
-
-            generation_id = generation_data['sdGenerationJob']['generationId']
-            app.logger.info(f"Generation job started with ID: {generation_id}")
-
-            for _ in range(30):
-                status_response = requests.get(
-                    f"{LEONARDO_API_BASE_URL}/generations/{generation_id}",
-                    headers=headers
-                )
-                status_response.raise_for_status()
-                status_data = status_response.json()
-
-                gen_info = status_data.get('generations_by_pk')
-                if gen_info and gen_info.get('status') == 'COMPLETE':
-                    app.logger.info("Leonardo.ai Generation complete!")
-                    for image in gen_info.get('generated_images', []):
-                        leonardo_image_urls.append(image['url'])
-                    break
-                elif gen_info and gen_info.get('status') == 'FAILED':
-                    app.logger.error("Leonardo.ai Generation failed!")
-                    return jsonify({"error": "Leonardo.ai image generation failed."}), 500
-
-                time.sleep(1)
-
-            if not leonardo_image_urls:
-                app.logger.error("Leonardo.ai image generation timed out or no images returned.")
-                return jsonify({"error": "Leonardo.ai image generation timed out or no images returned."}), 500
-
-            app.logger.info(f"Received {len(leonardo_image_urls)} images from Leonardo.ai.")
-            local_image_paths = save_images_locally(leonardo_image_urls, final_prompt_for_image_gen + f"(Model: {selected_model_id})") # Save enhanced prompt
-            if not local_image_paths:
-                return jsonify({"error": "No images were successfully saved locally from Leonardo.ai."}), 500
-            return jsonify({"images": local_image_paths})
-
-        except requests.exceptions.HTTPError as http_err:
-            app.logger.error(f"Leonardo.ai HTTP error occurred: {http_err}")
-            app.logger.error(f"Leonardo.ai Response content: {http_err.response.text}")
-            return jsonify({"error": f"Leonardo.ai API error: {http_err.response.text}"}), http_err.response.status_code
-        except requests.exceptions.RequestException as req_err:
-            app.logger.error(f"Leonardo.ai Request error occurred: {req_err}")
-            return jsonify({"error": "Leonardo.ai network or API connection error."}), 500
-        except Exception as e:
-            app.logger.critical(f"An unexpected error occurred during Leonardo.ai call: {e}", exc_info=True)
-            return jsonify({"error": "An internal server error occurred during Leonardo.ai call."}), 500
+    # Construct initial prompt
+    initial_prompt_for_gemini = PROMPT_TEMPLATES.get(jewelry_type, FALLBACK_PROMPT).format(
+        gender=gender,
+        jewelry_option=jewelry_option,
+        metal_type=metal_type,
+        center_stone_cut=center_stone_cut,
+        center_stone_shape=center_stone_shape,
+        center_stone_type=center_stone_type,
+        side_stone_cut=side_stone_cut,
+        side_stone_shape=side_stone_shape,
+        side_stone_type=side_stone_type,
+        setting_type=setting_type,
+        product_style=product_style or '[Product Style]',
+        description=description or '[Comments]'
+    )
+
+    # Reuse the images from an identical earlier request unless the caller asks for a fresh generation
+    # (newVariations in the body, or ?nocache=1)
+    cache_key = generation_cache_key(selected_model_id, num_images, enhance_prompt, initial_prompt_for_gemini)
+    if not design_request.newVariations and request.args.get('nocache') != '1':
+        cached_images = find_cached_generation(cache_key)
+        if cached_images:
+            app.logger.info("Returning %s cached images for an identical request.", len(cached_images))
+            return jsonify({"images": cached_images})
+
+    # Hand prompt enhancement, the provider call, polling and downloads to a background thread and answer right away
+    # 16 URL-safe characters; short folder names keep image paths and URLs compact
+    folder_id = secrets.token_urlsafe(12)
+    create_generation_job(folder_id)
+    GENERATION_EXECUTOR.submit(
+        run_generation_job, folder_id, selected_model_id, initial_prompt_for_gemini, enhance_prompt, num_images, cache_key
+    )
+    app.logger.info("Queued generation %s with model %s.", folder_id, selected_model_id)
+    return jsonify({"folder_id": folder_id, "status": "pending"}), 202
+
+
+@app.route('/status/<folder_id>')
+def generation_status(folder_id):
+    job = get_generation_job(folder_id)
+    if job is None:
+        return jsonify({"error": "Unknown generation."}), 404
+    return jsonify(job)
+
+
+@app.route('/leonardo-webhook', methods=['POST'])
+def leonardo_webhook():
+    if not LEONARDO_WEBHOOK_API_KEY:
+        return jsonify({"error": "Leonardo.ai webhook is not configured."}), 404
+    # Leonardo sends the callback API key configured alongside the webhook URL as a bearer token
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {LEONARDO_WEBHOOK_API_KEY}"):
+        app.logger.warning("Rejected Leonardo.ai webhook with an invalid authorization header.")
+        return jsonify({"error": "Unauthorized."}), 401
+
+    # Malformed payloads get a 400 rather than a 500, which Leonardo would keep retrying
+    event = request.get_json(silent=True)
+    data = event.get('data') if isinstance(event, dict) else None
+    generation = data.get('object') if isinstance(data, dict) else None
+    if not isinstance(generation, dict):
+        return jsonify({"error": "Malformed webhook payload."}), 400
+    generation_id = generation.get('id')
+    if not generation_id or not isinstance(generation_id, str):
+        return jsonify({"error": "Missing generation id."}), 400
+    images = generation.get('images') or []
+    if not isinstance(images, list) or not all(isinstance(image, dict) for image in images):
+        return jsonify({"error": "Malformed webhook payload."}), 400
+
+    status = generation.get('status')
+    if status not in ('COMPLETE', 'FAILED'):
+        return jsonify({"received": True})
+
+    gen_info = {
+        "status": status,
+        "generated_images": [{"url": image['url']} for image in images if image.get('url')]
+    }
+    try:
+        leonardo_callback_future(generation_id).set_result(gen_info)
+    except InvalidStateError:
+        pass # Leonardo retried a callback that was already delivered
+    app.logger.info("Leonardo.ai webhook: generation %s is %s.", generation_id, status)
+    return jsonify({"received": True})
 
 
 @app.route('/get-saved-designs', methods=['GET'])
 def get_saved_designs():
     app.logger.info("Fetching saved designs.")
-    saved_designs_data = []
-    for folder_name in os.listdir(GENERATED_IMAGES_DIR):
-        folder_path = os.path.join(GENERATED_IMAGES_DIR, folder_name)
-        if os.path.isdir(folder_path):
-            prompt_file = os.path.join(folder_path, 'prompt.txt')
-            prompt_text = "No prompt available."
-            if os.path.exists(prompt_file):
-                try:
-                    with open(prompt_file, 'r', encoding='utf-8') as f:
-                        prompt_text = f.read()
-                except Exception as e:
-                    app.logger.error(f"Error reading prompt.txt in {folder_name}: {e}")
-
-            images_in_folder = []
-            for filename in os.listdir(folder_path):
-                if filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.webp')):
-                    images_in_folder.append(f"/static/generated_designs/{folder_name}/{filename}")
-
-            if images_in_folder:
-                saved_designs_data.append({
-                    "folder_id": folder_name,
-                    "prompt": prompt_text,
-                    "images": sorted(images_in_folder)
-                })
-    saved_designs_data.sort(
-        key=lambda x: os.path.getmtime(os.path.join(GENERATED_IMAGES_DIR, x['folder_id'])),
-        reverse=True
-    )    
-
-    app.logger.info(f"Found {len(saved_designs_data)} saved design folders.")
-    return jsonify(saved_designs_data)
+    fingerprint = saved_designs_fingerprint()
+    with _saved_designs_lock:
+        if _saved_designs_cache["body"] is None or _saved_designs_cache["fingerprint"] != fingerprint:
+            body = orjson.dumps(load_saved_designs())
+            _saved_designs_cache["body"] = body
+            _saved_designs_cache["etag"] = hashlib.sha1(body).hexdigest()
+            _saved_designs_cache["fingerprint"] = fingerprint
+        body = _saved_designs_cache["body"]
+        etag = _saved_designs_cache["etag"]
+    # Let the browser revalidate with If-None-Match and get a 304 when nothing changed
+    response = Response(body, mimetype=app.json.mimetype)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.set_etag(etag)
+    return response.make_conditional(request)
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5000, host='0.0.0.0')
\ No newline at end of file
+    # Development server only; production runs under gunicorn (see Dockerfile)
+    app.run(debug=os.getenv("FLASK_DEBUG", "0") == "1", port=5000, host='0.0.0.0')
\ No newline at end of file
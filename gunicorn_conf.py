@@ -0,0 +1,13 @@
+# Gunicorn settings for the production container (see Dockerfile); use `python app.py` for local development.
+import multiprocessing
+import os
+
+bind = "0.0.0.0:5000"
+
+# Threaded workers rather than gevent: requests only queue generations and return, while the background
+# generation jobs encode WebP images with Pillow, which would stall a gevent worker's event loop.
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count())) # One per CPU by default
+threads = int(os.getenv("GUNICORN_THREADS", "16")) # Concurrent requests per worker
+timeout = 120
+keepalive = 5 # Seconds; keeps browser connections open between status polls
@@ -5,7 +5,7 @@ angular.module('jewelryApp', [])
         return input.charAt(0).toUpperCase() + input.slice(1).toLowerCase();
     };
 })
-.controller('JewelryController', ['$http', function($http) {
+.controller('JewelryController', ['$http', '$timeout', function($http, $timeout) {
     var vm = this; // ViewModel pattern
     vm.design = {
         jewelry_type: 'ring',
@@ -16,6 +16,7 @@ angular.module('jewelryApp', [])
         numImages: 1, // Default number of images
         model: '5c232a9e-9061-4777-980a-ddc8e65647c6', // Default model
         enhancePrompt: false, // NEW: Default to true (checked)
+        newVariations: false, // Generate fresh images instead of reusing an identical earlier request's
         challenge: '', // NEW: Field for challenge passphrase
         product_style: '', // NEW: Field for product style
         setting_type: '' // NEW: Field for setting type
@@ -73,8 +74,14 @@ angular.module('jewelryApp', [])
         }
 
         // Send the model ID and numImages along with other design parameters
-        $http.post('/generate-jewelry', vm.design)
+        // The passphrase also goes in a header so the server can reject bad ones without parsing the body
+        $http.post('/generate-jewelry', vm.design, { headers: { 'X-Challenge': vm.design.challenge || '' } })
             .then(function(response) {
+                // 202: the generation runs in the background, poll its status until it finishes
+                if (response.status === 202 && response.data && response.data.folder_id) {
+                    vm.pollGenerationStatus(response.data.folder_id);
+                    return;
+                }
                 vm.isLoading = false;
                 if (response.data && response.data.images) {
                     vm.images = response.data.images;
@@ -90,6 +97,29 @@ angular.module('jewelryApp', [])
             });
     };
 
+    vm.pollGenerationStatus = function(folderId) {
+        $http.get('/status/' + folderId)
+            .then(function(response) {
+                var job = response.data;
+                if (job.status === 'pending' || job.status === 'running') {
+                    $timeout(function() { vm.pollGenerationStatus(folderId); }, 1500);
+                    return;
+                }
+                vm.isLoading = false;
+                if (job.status === 'complete' && job.images && job.images.length) {
+                    vm.images = job.images;
+                    vm.fetchSavedDesigns(); // Refresh saved designs after a new generation
+                } else {
+                    vm.errorMessage = "Failed to generate images. " + (job.error || "Server error.");
+                }
+            })
+            .catch(function(error) {
+                vm.isLoading = false;
+                console.error("Error checking generation status:", error);
+                vm.errorMessage = "Failed to generate images. " + (error.data && error.data.error ? error.data.error : "Server error.");
+            });
+    };
+
     // --- NEW: Function to fetch saved designs ---
     vm.fetchSavedDesigns = function() {
         $http.get('/get-saved-designs')